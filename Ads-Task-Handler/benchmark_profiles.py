@@ -0,0 +1,93 @@
+"""
+ Copyright 2020 Google Inc.
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+"""Compares the landing page report download cost of the report profiles.
+
+For each CID given on the command line, yesterday's landing page report is
+downloaded once per report profile and the size of the report and the time
+taken to download it are printed. Nothing is staged or loaded into bigquery.
+
+The script uses the same firestore credentials and report profiles as the
+Ads-Task-Handler, so it must be run with application default credentials for
+the solution's project and GOOGLE_CLOUD_PROJECT set, e.g.
+
+  GOOGLE_CLOUD_PROJECT=my-project python benchmark_profiles.py 1234567890
+
+Importing the handler's main module creates a Cloud Logging client and attaches
+its handler to the Ads-Service logger, so the script's credentials also need
+permission to write logs to the project.
+"""
+
+import argparse
+import time
+
+from google.cloud import firestore
+
+import main
+
+
+def benchmark_profile(ads_client, report_cols):
+  """Downloads yesterday's landing page report with the given columns.
+
+  Args:
+    ads_client: an instance of AdWordsClient authenticated for the CID.
+    report_cols: the columns to select in the report.
+
+  Returns:
+    A tuple of the report size in bytes and the download time in seconds.
+  """
+  download_start = time.monotonic()
+  landing_page_report = main.download_landing_page_report(
+      ads_client, report_cols, date_range='YESTERDAY')
+  report_bytes = 0
+  try:
+    while True:
+      report_line = landing_page_report.readline()
+      if not report_line: break
+      report_bytes += len(report_line)
+  finally:
+    landing_page_report.close()
+  return report_bytes, time.monotonic() - download_start
+
+
+def main_cli():
+  parser = argparse.ArgumentParser(
+      description='Compares the landing page report download cost of the '
+      'report profiles.')
+  parser.add_argument(
+      'cids', nargs='+', help='the CIDs to download reports for')
+  parser.add_argument(
+      '--profiles',
+      nargs='+',
+      help='the report profiles to compare, defaults to every profile in '
+      'firestore and the default profiles')
+  args = parser.parse_args()
+
+  storage_client = firestore.Client()
+  profile_names = args.profiles
+  if not profile_names:
+    profile_names = list(main.get_report_profiles(storage_client))
+  print('cid,profile,columns,bytes,seconds')
+  for cid in args.cids:
+    ads_client = main.get_ads_client(storage_client, cid)
+    for profile_name in profile_names:
+      report_cols = main.get_report_columns(storage_client, profile_name)
+      report_bytes, seconds = benchmark_profile(ads_client, report_cols)
+      print(f'{cid},{profile_name},{len(report_cols)},{report_bytes},'
+            f'{seconds:.2f}')
+
+
+if __name__ == '__main__':
+  main_cli()
@@ -16,26 +16,34 @@
 """This service retrieves and forwards landing page reports in CSV format.
 
 The Ads-Task-Handler downloads the landing page report for the Google Ads
-account with the given CID. The report is then enriched with the name provided,
+account with the given CID. The metrics included in the report are set by the
+named report profile given in the request, which is looked up in the
+agency_ads/report_profiles firestore document and falls back to the built-in
+DEFAULT_REPORT_PROFILES. The report is then enriched with the name provided,
 the CID, and a base URL for the landing page. The base URL is the landing page
 URL stripped of parameters after {ignore} and any trailing '?' or '/'.
 
-The enriched landing page report is then loaded into the
-agency_dashboard.ads_data biqquery table of the working Google CLoud project.
+The enriched landing page report is then staged as a newline delimited JSON
+file in the ads staging Cloud Storage bucket of the working Google Cloud
+project. The controller service compacts the staged files into a few large load
+jobs against the agency_dashboard.ads_data bigquery table once all of the Ads
+tasks have finished, so each task returns as soon as its file is written.
 """
 
 import csv
 from datetime import datetime
+import json
 import logging
 import os
+import time
 
 from bottle import Bottle
 from bottle import HTTPError
 from bottle import request
 from googleads import adwords
 
-from google.cloud import bigquery
 from google.cloud import firestore
+from google.cloud import storage
 import google.cloud.exceptions
 import google.cloud.logging
 
@@ -91,7 +99,135 @@ REPORT_COLS = {
     'View rate': 'VideoViewRate'
 }
 
+# The report attributes selected regardless of the report profile. The base url
+# and date are required by the ads_data table.
+ATTRIBUTE_COLS = [
+    'CampaignId', 'CampaignName', 'CampaignStatus', 'UnexpandedFinalUrlString',
+    'Date', 'Device'
+]
+
+# The metrics selected for each report profile. These are used when the profile
+# isn't in the agency_ads/report_profiles firestore document, which maps profile
+# names to lists of metric names as used in the select statement.
+DEFAULT_REPORT_PROFILES = {
+    'daily': [
+        'AllConversions', 'AverageCpc', 'Clicks', 'ConversionRate',
+        'Conversions', 'ConversionValue', 'Cost', 'Ctr', 'Impressions',
+        'PercentageMobileFriendlyClicks',
+        'PercentageValidAcceleratedMobilePagesClicks', 'SpeedScore'
+    ],
+    'full': [
+        col for col in REPORT_COLS.values() if col not in ATTRIBUTE_COLS
+    ],
+}
+DEFAULT_PROFILE = 'daily'
+
 PROJECT_NAME = os.environ['GOOGLE_CLOUD_PROJECT']
+# The bucket and object prefix the transformed report rows are staged under
+# until the controller service loads them into bigquery.
+STAGING_BUCKET = f'{PROJECT_NAME}-ads-staging'
+STAGED_PREFIX = 'staged/'
+
+
+def get_ads_client(storage_client, customer_id):
+  """Creates an Ads client for the given CID from the stored credentials.
+
+  Args:
+    storage_client: an instance of the firestore client.
+    customer_id: the client customer id the Ads client is for.
+
+  Returns:
+    An instance of AdWordsClient authenticated for the given CID.
+
+  Raises:
+    google.cloud.exceptions.NotFound: the credentials document was not in the
+    agency_ads collection
+  """
+  credentials_doc = (
+      storage_client.collection('agency_ads').document('credentials').get())
+  developer_token = credentials_doc.get('developer_token')
+  client_id = credentials_doc.get('client_id')
+  client_secret = credentials_doc.get('client_secret')
+  refresh_token = credentials_doc.get('refresh_token')
+  ads_credentials = ('adwords:\n' + f' client_customer_id: {customer_id}\n' +
+                     f' developer_token: {developer_token}\n' +
+                     f' client_id: {client_id}\n' +
+                     f' client_secret: {client_secret}\n' +
+                     f' refresh_token: {refresh_token}')
+  return adwords.AdWordsClient.LoadFromString(ads_credentials)
+
+
+def get_report_profiles(storage_client):
+  """Retrieves the report profiles.
+
+  Args:
+    storage_client: an instance of the firestore client.
+
+  Returns:
+    A dict of the default report profiles updated with the profiles in the
+    agency_ads/report_profiles firestore document.
+  """
+  profiles_doc = (
+      storage_client.collection('agency_ads').document('report_profiles').get())
+  profiles = dict(DEFAULT_REPORT_PROFILES)
+  profiles.update(profiles_doc.to_dict() or {})
+  return profiles
+
+
+def get_report_columns(storage_client, profile_name):
+  """Retrieves the columns to select for the given report profile.
+
+  Args:
+    storage_client: an instance of the firestore client.
+    profile_name: the name of the report profile to use.
+
+  Returns:
+    A list of the report attributes followed by the profile's metrics, using
+    the names from the select statement.
+
+  Raises:
+    KeyError: the profile isn't defined in firestore or the default profiles.
+    ValueError: the profile isn't a list of column names in REPORT_COLS.
+  """
+  metrics = get_report_profiles(storage_client)[profile_name]
+  if (not isinstance(metrics, list) or
+      not all(isinstance(col, str) for col in metrics)):
+    raise ValueError(f'Report profile {profile_name} is not a list of column '
+                     f'names: {metrics!r}')
+
+  unknown_cols = set(metrics) - set(REPORT_COLS.values())
+  if unknown_cols:
+    raise ValueError(f'Unknown report columns: {", ".join(unknown_cols)}')
+
+  return ATTRIBUTE_COLS + [col for col in metrics if col not in ATTRIBUTE_COLS]
+
+
+def download_landing_page_report(ads_client, report_cols, **during):
+  """Starts the download of the landing page report.
+
+  Args:
+    ads_client: an instance of AdWordsClient authenticated for the CID.
+    report_cols: the columns to select in the report.
+    **during: the date_range, or start_date and end_date, passed to the report
+      query's During.
+
+  Returns:
+    A stream of the report in CSV format without the report header or summary.
+  """
+  landing_page_query = adwords.ReportQueryBuilder()
+  # selecting campaign attributes, unexpanded final url, device,
+  # date, and the landing page metrics of the report profile.
+  landing_page_query.Select(','.join(report_cols))
+  landing_page_query.From('LANDING_PAGE_REPORT')
+  landing_page_query.During(**during)
+  landing_page_query = landing_page_query.Build()
+
+  report_downloader = ads_client.GetReportDownloader(version='v201809')
+  return report_downloader.DownloadReportAsStreamWithAwql(
+      landing_page_query,
+      'CSV',
+      skip_report_header=True,
+      skip_report_summary=True)
 
 
 @app.route('/')
@@ -104,6 +240,9 @@ def export_landing_page_report():
   is a date stored in firestore. The last run date is updated after the report
   is downloaded from Ads.
 
+  The metrics in the report are chosen by the report profile named in the
+  profile parameter, or the daily profile if none is given.
+
   Returns:
     The landing page report in CSV format
 
@@ -113,6 +252,7 @@ def export_landing_page_report():
   customer_id = request.params.get('cid')
   customer_name = request.params.get('name')
   start_date = request.params.get('startdate')
+  profile_name = request.params.get('profile', DEFAULT_PROFILE)
   if not customer_id:
     logger.error('Client customer id (cid) not included in request')
     raise HTTPError(400,
@@ -121,29 +261,22 @@ def export_landing_page_report():
   storage_client = firestore.Client()
 
   try:
-    credentials_doc = (
-        storage_client.collection('agency_ads').document('credentials').get())
-    developer_token = credentials_doc.get('developer_token')
-    client_id = credentials_doc.get('client_id')
-    client_secret = credentials_doc.get('client_secret')
-    refresh_token = credentials_doc.get('refresh_token')
-    ads_credentials = ('adwords:\n' + f' client_customer_id: {customer_id}\n' +
-                       f' developer_token: {developer_token}\n' +
-                       f' client_id: {client_id}\n' +
-                       f' client_secret: {client_secret}\n' +
-                       f' refresh_token: {refresh_token}')
+    report_cols = get_report_columns(storage_client, profile_name)
+  except KeyError:
+    logger.error('Unknown report profile %s', profile_name)
+    raise HTTPError(400, 'Unknown report profile %s' % profile_name)
+  except ValueError:
+    logger.exception('Invalid report profile %s', profile_name)
+    raise HTTPError(500, 'Invalid report profile %s' % profile_name)
+
+  try:
+    ads_client = get_ads_client(storage_client, customer_id)
   except google.cloud.exceptions.NotFound:
     logger.exception('Unable to load ads credentials.')
     raise HTTPError(500, 'Unable to load Ads credentials.')
 
-  ads_client = adwords.AdWordsClient.LoadFromString(ads_credentials)
-  landing_page_query = adwords.ReportQueryBuilder()
-  # selecting campaign attributes, unexpanded final url, device,
-  # date, and all of the landing page metrics.
-  landing_page_query.Select(','.join(REPORT_COLS.values()))
-  landing_page_query.From('LANDING_PAGE_REPORT')
   if not start_date:
-    landing_page_query.During(date_range='YESTERDAY')
+    during = {'date_range': 'YESTERDAY'}
   else:
     try:
       start_date = datetime.date.fromisoformat(start_date)
@@ -152,40 +285,38 @@ def export_landing_page_report():
       logger.info('Invalid date passed in startdate parameter.')
       raise HTTPError(400, 'Invalid date in startdate parameter.')
     if start_date == datetime.date.today():
-      landing_page_query.During(date_range='TODAY')
+      during = {'date_range': 'TODAY'}
     else:
       if today < start_date:
         logger.error('Last run date in the future (start_date: %s)', start_date)
         raise HTTPError(400,
                         'startdate in the future (start_date: %s)' % start_date)
 
-      landing_page_query.During(
-          start_date=start_date.strftime('%Y%m%d'),
-          end_date=today.strftime('%Y%m%d'))
-
-  landing_page_query = landing_page_query.Build()
+      during = {
+          'start_date': start_date.strftime('%Y%m%d'),
+          'end_date': today.strftime('%Y%m%d')
+      }
 
-  report_downloader = ads_client.GetReportDownloader(version='v201809')
+  download_start = time.monotonic()
   try:
-    landing_page_report = (
-        report_downloader.DownloadReportAsStreamWithAwql(
-            landing_page_query,
-            'CSV',
-            skip_report_header=True,
-            skip_report_summary=True))
+    landing_page_report = download_landing_page_report(ads_client,
+                                                       report_cols, **during)
   except Exception as e:
     logger.exception('Problem with retrieving landing page report')
     raise HTTPError(500, 'Unable to retrieve landing page report %s' % e)
 
   ads_cols = []
   ads_rows = []
+  report_bytes = 0
   try:
     while True:
       report_line = landing_page_report.readline()
       if not report_line: break
+      report_bytes += len(report_line)
 
       report_line = report_line.decode().replace('\n', '')
-      report_row = report_line.split(',')
+      # campaign names and urls can contain quoted commas.
+      report_row = next(csv.reader([report_line]))
 
       if not ads_cols:
         ads_cols = report_row
@@ -207,7 +338,11 @@ def export_landing_page_report():
       # Ads reports return percentages as strings with %, so we change them
       # back to numbers between 0 and 1
       # we also need to change -- to 0 to insert values.
+      # Only the metrics are converted, the attributes, CID, and client name
+      # are STRING columns in ads_data and the JSON load won't convert numbers.
       for k, v in report_row.items():
+        if k in ATTRIBUTE_COLS or k in ('BaseUrl', 'CID', 'ClientName'):
+          continue
         if v.endswith('%'):
           report_row[k] = float(v[0:-1]) / 100
         elif v.isdecimal():
@@ -222,37 +357,28 @@ def export_landing_page_report():
   finally:
     landing_page_report.close()
 
+  logger.info('Report profile %s for cid %s: %d bytes, %d rows in %.2fs',
+              profile_name, customer_id, report_bytes, len(ads_rows),
+              time.monotonic() - download_start)
+
   if ads_rows:
-    csv_file_name = '/tmp/ads_data.' + str(datetime.timestamp(datetime.now()))
-    with open(csv_file_name, 'w', newline='') as csv_file:
-      try:
-        csv_writer = csv.DictWriter(csv_file, fieldnames=ads_cols)
-        csv_writer.writeheader()
-        csv_writer.writerows(ads_rows)
-      except OSError as os_error:
-        logger.exception(
-            'Problem writing the landing page report to a temp file: %s', e)
-        raise HTTPError(500, 'Unable to write landing page report to file.')
+    staged_name = (f'{STAGED_PREFIX}{customer_id}-' +
+                   f'{datetime.timestamp(datetime.now())}.json')
+    staged_data = '\n'.join(json.dumps(row) for row in ads_rows) + '\n'
     try:
-      bq_client = bigquery.Client()
-      bq_table = bq_client.get_table(
-          f'{PROJECT_NAME}.agency_dashboard.ads_data')
-      bq_job_config = bigquery.LoadJobConfig()
-      bq_job_config.source_format = bigquery.SourceFormat.CSV
-      bq_job_config.skip_leading_rows = 1
-      bq_job_config.autodetect = True
-      with open(csv_file_name, 'rb') as csv_file:
-        try:
-          bq_job = bq_client.load_table_from_file(
-              csv_file, bq_table, job_config=bq_job_config)
-          bq_job_result = bq_job.result()
-        except Exception as ex:
-          logger.exception('Problem loading ads data into bigquery: %s', ex)
-          raise ex
+      gcs_client = storage.Client()
+      staging_bucket = gcs_client.bucket(STAGING_BUCKET)
+      staging_bucket.blob(staged_name).upload_from_string(
+          staged_data, content_type='application/json')
+    except google.cloud.exceptions.NotFound:
+      logger.exception(
+          'Staging bucket gs://%s not found, create it with '
+          '`gsutil mb gs://%s`.', STAGING_BUCKET, STAGING_BUCKET)
+      raise HTTPError(500, 'Staging bucket not found.')
     except google.cloud.exceptions.GoogleCloudError as gce:
-      logger.exception('Problem loading ads data into bigquery: %s',
+      logger.exception('Problem staging ads data for cid %s: %s', customer_id,
                        gce.message)
-      raise gce
+      raise HTTPError(500, 'Unable to stage landing page report.')
 
 if __name__ == '__main__':
   app.run(host='localhost', port=8090)
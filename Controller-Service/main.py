@@ -20,30 +20,54 @@ report requests and lighthouse audits.
 This module runs as a web service and is designed to be targeted by Google Cloud
 Scheduler. Using credentials stored in firestore, it first requests all of the
 CIDs associated with the stored MCC ID from Ads. Using those CIDs, it creates
-Cloud tasks to have landing page reports retrieved and stored in bigquery. Once
-the landing page report tasks have been completed, it creates tasks to run
-lighthouse audits on all of the URLs in the project's base_urls bigquery table
-and have them stored in bigquery.
+Cloud tasks to have landing page reports retrieved and staged in Cloud Storage.
+Once the landing page report tasks have been completed, the staged reports are
+compacted into a few bigquery load jobs and it creates tasks to run lighthouse
+audits on all of the URLs in the project's base_urls bigquery table and have
+them stored in bigquery.
 """
 
 import datetime
+import functools
+import hashlib
 import logging
 import os
 import time
 import urllib
+import uuid
 
 from bottle import Bottle
 from bottle import HTTPError
+from bottle import request
 from googleads import adwords
 
 import google.cloud.bigquery
 import google.cloud.exceptions
 import google.cloud.firestore
 import google.cloud.logging
+import google.cloud.storage
 import google.cloud.tasks
 
 app = Bottle()
 
+# The object prefix the Ads-Task-Handler stages report rows under.
+STAGED_PREFIX = 'staged/'
+# The object prefix staged files that can't be loaded into bigquery are moved
+# to.
+FAILED_PREFIX = 'failed/'
+# The number of staged files loaded per bigquery load job. Bigquery allows at
+# most 10,000 source URIs per load job.
+STAGED_FILES_PER_LOAD = 5000
+# The number of staged files deleted per Cloud Storage batch request, which
+# allows at most 100 calls.
+DELETES_PER_REQUEST = 100
+# How long a controller run holds the lease on compacting the staged files
+# without renewing it. The lease is renewed before each load job.
+COMPACTION_LEASE = datetime.timedelta(hours=1)
+# The names of the built-in report profiles of the Ads-Task-Handler. These must
+# match its DEFAULT_REPORT_PROFILES.
+DEFAULT_REPORT_PROFILES = ('daily', 'full')
+
 
 def get_cids(ads_client, mcc_id):
   """Fetches all of the cids under the given mcc.
@@ -82,10 +106,325 @@ def get_cids(ads_client, mcc_id):
   return cids
 
 
+def renew_compaction_lease(storage_client, lease_id):
+  """Takes or renews the lease on compacting the staged files.
+
+  The lease is held in the agency_ads/staging firestore document so that
+  overlapping controller runs don't load the same staged files.
+
+  Args:
+    storage_client: an instance of the firestore client.
+    lease_id: the id of the controller run taking the lease.
+
+  Returns:
+    True if the lease is held by lease_id, otherwise False.
+  """
+  lease_doc = storage_client.collection('agency_ads').document('staging')
+
+  @google.cloud.firestore.transactional
+  def take_lease(transaction):
+    lease = lease_doc.get(transaction=transaction).to_dict() or {}
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if (lease.get('holder') not in (None, lease_id) and
+        lease.get('expires', now) > now):
+      return False
+    transaction.set(lease_doc, {
+        'holder': lease_id,
+        'expires': now + COMPACTION_LEASE
+    })
+    return True
+
+  return take_lease(storage_client.transaction())
+
+
+def release_compaction_lease(storage_client, lease_id):
+  """Releases the lease on compacting the staged files if lease_id holds it.
+
+  Args:
+    storage_client: an instance of the firestore client.
+    lease_id: the id of the controller run releasing the lease.
+  """
+  lease_doc = storage_client.collection('agency_ads').document('staging')
+
+  @google.cloud.firestore.transactional
+  def drop_lease(transaction):
+    lease = lease_doc.get(transaction=transaction).to_dict() or {}
+    if lease.get('holder') == lease_id:
+      transaction.update(lease_doc, {'holder': None})
+
+  drop_lease(storage_client.transaction())
+
+
+def report_profile_exists(storage_client, profile_name):
+  """Checks if the Ads-Task-Handler can use the given report profile.
+
+  Args:
+    storage_client: an instance of the firestore client.
+    profile_name: the name of the report profile.
+
+  Returns:
+    True if the profile is a default profile or is in the
+    agency_ads/report_profiles firestore document, otherwise False.
+  """
+  if profile_name in DEFAULT_REPORT_PROFILES:
+    return True
+  profiles_doc = (
+      storage_client.collection('agency_ads').document('report_profiles').get())
+  return profile_name in (profiles_doc.to_dict() or {})
+
+
+def ensure_staging_bucket(project_name, logger):
+  """Creates the bucket the Ads reports are staged in if it's missing.
+
+  Deployments installed before the reports were staged don't have the bucket,
+  and every Ads task would fail without it.
+
+  Args:
+    project_name: the name of the Google Cloud project.
+    logger: the logger to report problems to.
+  """
+  staging_bucket = f'{project_name}-ads-staging'
+  gcs_client = google.cloud.storage.Client()
+  if gcs_client.lookup_bucket(staging_bucket) is None:
+    logger.warning('Creating missing ads staging bucket gs://%s',
+                   staging_bucket)
+    gcs_client.create_bucket(staging_bucket)
+
+
+def commit_staged_batch(gcs_client, batch_doc, staging_bucket, files):
+  """Removes the staged files of a loaded batch and then its firestore record.
+
+  Args:
+    gcs_client: an instance of the Cloud Storage client.
+    batch_doc: the firestore document reference tracking the batch.
+    staging_bucket: the name of the bucket the files are staged in.
+    files: the names of the staged files loaded by the batch.
+  """
+  bucket = gcs_client.bucket(staging_bucket)
+  for i in range(0, len(files), DELETES_PER_REQUEST):
+    chunk = files[i:i + DELETES_PER_REQUEST]
+    try:
+      with gcs_client.batch():
+        bucket.delete_blobs(chunk, on_error=lambda blob: None)
+    except google.cloud.exceptions.NotFound:
+      # some of the files were deleted by an earlier attempt. Batched deletes
+      # only report errors when the batch is sent, so the rest are deleted
+      # one at a time.
+      bucket.delete_blobs(chunk, on_error=lambda blob: None)
+  batch_doc.delete()
+
+
+def recover_staged_batch(bigquery_client, gcs_client, staging_bucket,
+                         batch_snapshot, logger):
+  """Resolves a staged batch left behind by an earlier run.
+
+  The batch is committed if its load job succeeded and dropped if the job
+  failed or never started. If the job can't be checked, the batch is kept for
+  the next run.
+
+  Args:
+    bigquery_client: an instance of the bigquery client.
+    gcs_client: an instance of the Cloud Storage client.
+    staging_bucket: the name of the bucket the files are staged in.
+    batch_snapshot: the firestore document snapshot of the batch record.
+    logger: the logger to report problems to.
+
+  Returns:
+    A list of the staged files still claimed by the batch.
+  """
+  batch = batch_snapshot.to_dict()
+  try:
+    load_job = bigquery_client.get_job(batch['job_id'])
+  except google.cloud.exceptions.NotFound:
+    logger.info('Load job for staged batch %s never started.',
+                batch_snapshot.id)
+    batch_snapshot.reference.delete()
+    return []
+  except google.cloud.exceptions.GoogleCloudError:
+    logger.exception('Unable to check load job for staged batch %s.',
+                     batch_snapshot.id)
+    return batch['files']
+  try:
+    load_job.result()
+  except google.cloud.exceptions.GoogleCloudError:
+    if load_job.state == 'DONE' and load_job.error_result:
+      logger.exception('Load job for staged batch %s failed.',
+                       batch_snapshot.id)
+      batch_snapshot.reference.delete()
+      return []
+    logger.exception('Unable to check load job for staged batch %s.',
+                     batch_snapshot.id)
+    return batch['files']
+  commit_staged_batch(gcs_client, batch_snapshot.reference, staging_bucket,
+                      batch['files'])
+  return []
+
+
+def quarantine_staged_file(gcs_client, staging_bucket, file_name):
+  """Moves a staged file that can't be loaded out of the staged files.
+
+  Args:
+    gcs_client: an instance of the Cloud Storage client.
+    staging_bucket: the name of the bucket the files are staged in.
+    file_name: the name of the staged file.
+
+  Returns:
+    The name the file was moved to.
+  """
+  bucket = gcs_client.bucket(staging_bucket)
+  blob = bucket.blob(file_name)
+  failed_name = FAILED_PREFIX + file_name[len(STAGED_PREFIX):]
+  bucket.copy_blob(blob, bucket, failed_name)
+  blob.delete()
+  return failed_name
+
+
+def load_staged_batch(project_name, bigquery_client, gcs_client,
+                      staging_bucket, batches, files, renew_lease, logger):
+  """Records a batch of staged files and loads it into the ads_data table.
+
+  If the load job fails because of the data, the batch is split in two and each
+  half is loaded on its own, until the files that fail by themselves are found.
+  Those are moved under FAILED_PREFIX so the rest of the files are committed.
+
+  Args:
+    project_name: the name of the Google Cloud project.
+    bigquery_client: an instance of the bigquery client.
+    gcs_client: an instance of the Cloud Storage client.
+    staging_bucket: the name of the bucket the files are staged in.
+    batches: the firestore collection reference of the batch records.
+    files: the names of the staged files to load.
+    renew_lease: a function renewing the compaction lease, returning False if
+      the lease was lost to another run.
+    logger: the logger to report problems to.
+  """
+  if not renew_lease():
+    logger.error('Lost the compaction lease, leaving %d staged files.',
+                 len(files))
+    return
+
+  batch_id = hashlib.sha256('\n'.join(files).encode()).hexdigest()
+  # job ids can't be reused, so a batch retried after a failed load needs a
+  # new one.
+  job_id = f'ads_data_compact_{batch_id}_{int(time.time())}'
+  batch_doc = batches.document(batch_id)
+  batch_doc.set({'job_id': job_id, 'files': files})
+
+  bq_job_config = google.cloud.bigquery.LoadJobConfig()
+  bq_job_config.source_format = (
+      google.cloud.bigquery.SourceFormat.NEWLINE_DELIMITED_JSON)
+  bq_job_config.write_disposition = (
+      google.cloud.bigquery.WriteDisposition.WRITE_APPEND)
+  load_job = None
+  try:
+    load_job = bigquery_client.load_table_from_uri(
+        [f'gs://{staging_bucket}/{file_name}' for file_name in files],
+        f'{project_name}.agency_dashboard.ads_data',
+        job_id=job_id,
+        job_config=bq_job_config)
+    load_job.result()
+  except google.cloud.exceptions.GoogleCloudError:
+    if (load_job is None or load_job.state != 'DONE' or
+        not load_job.error_result):
+      # the batch record is kept so the next run can check the job's outcome.
+      logger.exception('Problem loading staged batch %s.', batch_id)
+      return
+    batch_doc.delete()
+    if len(files) == 1:
+      failed_name = quarantine_staged_file(gcs_client, staging_bucket,
+                                           files[0])
+      logger.error('Unable to load staged file %s, moved it to %s: %s',
+                   files[0], failed_name, load_job.error_result)
+      return
+    logger.warning('Load of staged batch %s failed, splitting it: %s',
+                   batch_id, load_job.error_result)
+    half = len(files) // 2
+    load_staged_batch(project_name, bigquery_client, gcs_client,
+                      staging_bucket, batches, files[:half], renew_lease,
+                      logger)
+    load_staged_batch(project_name, bigquery_client, gcs_client,
+                      staging_bucket, batches, files[half:], renew_lease,
+                      logger)
+    return
+  commit_staged_batch(gcs_client, batch_doc, staging_bucket, files)
+
+
+def compact_staged_ads_data(project_name, storage_client, logger):
+  """Loads the staged Ads report files into the ads_data bigquery table.
+
+  Each batch of staged files is recorded in firestore under
+  agency_ads/staging/batches before its load job is started and the record is
+  only removed once the job has succeeded and the files have been deleted. A
+  batch left behind by an earlier run is resolved by looking up its job instead
+  of loading the files a second time. Batches whose job failed or never started
+  are dropped and their files are picked up again with the remaining staged
+  files. Batches whose job can't be checked are kept and their files are left
+  for the next run, so every staged file is committed to bigquery exactly once.
+  Files that fail to load on their own are moved under FAILED_PREFIX.
+
+  Only one controller run compacts at a time. A run that can't take the
+  compaction lease leaves the staged files to the run holding it.
+
+  Problems with a single batch are logged and don't stop the other batches.
+
+  Args:
+    project_name: the name of the Google Cloud project.
+    storage_client: an instance of the firestore client.
+    logger: the logger to report problems to.
+  """
+  lease_id = uuid.uuid4().hex
+  if not renew_compaction_lease(storage_client, lease_id):
+    logger.info('Staged ads data is being compacted by another run.')
+    return
+  try:
+    staging_bucket = f'{project_name}-ads-staging'
+    bigquery_client = google.cloud.bigquery.Client()
+    gcs_client = google.cloud.storage.Client()
+    batches = (
+        storage_client.collection('agency_ads').document('staging').collection(
+            'batches'))
+    renew_lease = functools.partial(renew_compaction_lease, storage_client,
+                                    lease_id)
+
+    # files claimed by a batch whose job outcome is still unknown. They are
+    # left out of this run so they can't be loaded again under a new job.
+    pending_files = set()
+    for batch_snapshot in batches.stream():
+      try:
+        pending_files.update(
+            recover_staged_batch(bigquery_client, gcs_client, staging_bucket,
+                                 batch_snapshot, logger))
+      except Exception:
+        logger.exception('Problem recovering staged batch %s.',
+                         batch_snapshot.id)
+        pending_files.update(
+            (batch_snapshot.to_dict() or {}).get('files', []))
+
+    staged_files = sorted(
+        blob.name
+        for blob in gcs_client.list_blobs(staging_bucket, prefix=STAGED_PREFIX)
+        if blob.name not in pending_files)
+
+    for i in range(0, len(staged_files), STAGED_FILES_PER_LOAD):
+      files = staged_files[i:i + STAGED_FILES_PER_LOAD]
+      try:
+        load_staged_batch(project_name, bigquery_client, gcs_client,
+                          staging_bucket, batches, files, renew_lease, logger)
+      except Exception:
+        logger.exception('Problem committing staged files %s to %s.',
+                         files[0], files[-1])
+  finally:
+    release_compaction_lease(storage_client, lease_id)
+
+
 @app.route('/')
 @app.route('/controller')
 def start_update():
-  """This route triggers the process of updating the ads and lighthouse data."""
+  """This route triggers the process of updating the ads and lighthouse data.
+
+  The optional profile parameter names the report profile the Ads tasks use to
+  choose the landing page report metrics.
+  """
 
   logging_client = google.cloud.logging.Client()
   logging_handler = logging_client.get_default_handler()
@@ -95,6 +434,7 @@ def start_update():
   project_name = os.environ['GOOGLE_CLOUD_PROJECT']
   project_location = os.environ['APP_LOCATION']
   today = datetime.date.today().isoformat()
+  report_profile = request.params.get('profile')
 
   ads_client = None
   task_client = None
@@ -121,6 +461,13 @@ def start_update():
     logger.exception('Unable to load ads credentials.')
     raise HTTPError(500, 'Unable to load Ads credentials.')
 
+  # an unknown profile would fail every Ads task after its last run date has
+  # been moved forward.
+  if report_profile and not report_profile_exists(storage_client,
+                                                  report_profile):
+    logger.error('Unknown report profile %s', report_profile)
+    raise HTTPError(400, 'Unknown report profile %s' % report_profile)
+
   try:
     config_doc = storage_client.collection('agency_ads').document('config')
     config_doc_snapshot = config_doc.get()
@@ -143,6 +490,13 @@ def start_update():
     logger.exception('Exception creating tasks client')
     raise HTTPError(500, 'Exception creating tasks client.')
 
+  # checked before any tasks are queued and last run dates are updated.
+  try:
+    ensure_staging_bucket(project_name, logger)
+  except:
+    logger.exception('Exception creating the ads staging bucket')
+    raise HTTPError(500, 'Exception creating the ads staging bucket.')
+
   try:
     cids = get_cids(ads_client, mcc_id.replace('-', ''))
   except:
@@ -156,6 +510,8 @@ def start_update():
                   f'?cid={cid}&' + f'name={urllib.parse.quote(client_name)}')
       if cid in last_run_dates:
         task_url += f'&startdate={last_run_dates[cid]}'
+      if report_profile:
+        task_url += f'&profile={urllib.parse.quote(report_profile)}'
       task = {'http_request': {'http_method': 'GET', 'url': task_url}}
     except TypeError:
       logger.exception('Error creating task_url for record %s - %s', cid,
@@ -179,6 +535,13 @@ def start_update():
     ads_queue_list = list(task_client.list_tasks(ads_queue_path))
     ads_queue_size = len(ads_queue_list)
 
+  # the lighthouse audits still run on the existing ads data if the staged
+  # reports can't be loaded.
+  try:
+    compact_staged_ads_data(project_name, storage_client, logger)
+  except:
+    logger.exception('Exception loading staged ads data')
+
   try:
     bigquery_client = google.cloud.bigquery.Client()
     url_query = f'''SELECT BaseUrl
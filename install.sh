@@ -34,7 +34,7 @@ above this and address the issue before trying again." >&2
 function enable_gcloud_services() {
   declare -a gcloud_services
   gcloud_services=("bigquery" "googleads" "cloudtasks" "firestore")
-  gcloud_services+=("pagespeedonline")
+  gcloud_services+=("pagespeedonline" "storage")
   
   local gservice
   for gservice in "${gcloud_services[@]}"; do
@@ -120,6 +120,18 @@ function create_bq_tables() {
   fi
 }
 
+#######################################
+# Creates the Cloud Storage bucket the Ads reports are staged in before they are
+# loaded into bigquery.
+#######################################
+function create_staging_bucket() {
+  if ! gsutil ls -b gs://"${project_id}"-ads-staging; then
+    if ! gsutil mb gs://"${project_id}"-ads-staging; then
+      err "creating the ads staging bucket"
+    fi
+  fi
+}
+
 #######################################
 # Deploys the configuration files for the solution.
 #
@@ -164,6 +176,8 @@ function main() {
   deploy_solution_services
   echo "Creating bigquery tables"
   create_bq_tables
+  echo "Creating the ads staging bucket"
+  create_staging_bucket
   echo "Deploying final configuration files"
   deploy_config_files
 